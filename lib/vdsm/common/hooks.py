@@ -5,21 +5,22 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
 
-import glob
 import hashlib
-import itertools
 import json
 import logging
 import os
 import os.path
 import pkgutil
+import stat
 import subprocess
 import sys
 import tempfile
-
-import six
+import threading
+import time
+import weakref
 
 from vdsm.common import commands
+from vdsm.common import concurrent
 from vdsm.common import exception
 from vdsm.common.constants import P_VDSM_HOOKS, P_VDSM_RUN
 
@@ -30,60 +31,160 @@ _LAUNCH_FLAGS_PATH = os.path.join(
     _LAUNCH_FLAGS_FILE,
 )
 
+_DIGEST_CHUNK_SIZE = 128 * 1024
+
+# Hook directory path -> (mtime_ns, candidate script paths)
+_scripts_cache = {}
+
+# Script path -> ((ino, size, mtime_ns, ctime_ns), checksum)
+_digest_cache = {}
+
+# The file system may not update the timestamps for changes made within the
+# same timestamp tick, so files modified or changed recently are not cached.
+# The ctime is checked as well, since package installs restore an old mtime.
+_CACHE_MIN_AGE = 1.0
+
+_HOOK_INFO_MIN_PARALLEL = 8
+_HOOK_INFO_MAX_WORKERS = 8
+
 
 def _scriptsPerDir(dir_name):
+    """
+    Return sorted list of executable scripts paths in hook directory dir_name.
+    """
     if os.path.isabs(dir_name):
         raise ValueError("Cannot use absolute path as hook directory")
-    head = dir_name
-    while head:
-        head, tail = os.path.split(head)
-        if tail == "..":
-            raise ValueError("Hook directory paths cannot contain '..'")
-    path = os.path.join(P_VDSM_HOOKS, dir_name, '*')
-    return [s for s in glob.glob(path)
-            if os.path.isfile(s) and os.access(s, os.X_OK)]
+    if ".." in dir_name.split(os.sep):
+        raise ValueError("Hook directory paths cannot contain '..'")
+    path = os.path.join(P_VDSM_HOOKS, dir_name)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        _scripts_cache.pop(path, None)
+        return []
+
+    # Installing or removing a hook script modifies the hook directory, so
+    # the directory mtime is enough to detect stale candidates. Changing the
+    # mode of a script or removing a symlink target does not modify the
+    # directory, so executability is checked on every call.
+    cached = _scripts_cache.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns:
+        candidates = cached[1]
+    else:
+        # DirEntry.is_file() uses the file type returned by readdir() and
+        # does not need a stat() call per entry on most file systems. Hidden
+        # files are skipped, as they were when listing the directory using
+        # glob.
+        with os.scandir(path) as it:
+            candidates = sorted(e.path for e in it
+                                if not e.name.startswith('.') and
+                                e.is_file())
+
+        if _cacheable(st):
+            _scripts_cache[path] = (st.st_mtime_ns, candidates)
+        else:
+            _scripts_cache.pop(path, None)
+
+    return [s for s in candidates if os.access(s, os.X_OK)]
+
+
+def _cacheable(st):
+    return time.time() - max(st.st_mtime, st.st_ctime) > _CACHE_MIN_AGE
 
 
 _DOMXML_HOOK = 1
 _JSON_HOOK = 2
 
+_data_files = threading.local()
+
+# vdsm does not modify its environment after startup, so copying this
+# snapshot is enough, and cheaper than decoding os.environ for every hook.
+_base_env = dict(os.environ)
+
+
+class _DataFile(object):
+    """
+    Temporary file used to pass data to hook scripts, reused by all hooks
+    run in the same thread. The file is removed when the thread exits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+
+    def detach(self):
+        """
+        Stop tracking the file, without removing it.
+        """
+        self._finalizer.detach()
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _open_data_file():
+    """
+    Return writable empty file descriptor and path of this thread data file.
+
+    Scripts may replace or remove the data file, and the temporary directory
+    may be cleaned while the thread is idle, so the file is reopened by path
+    without O_CREAT. If the file is missing, or is not a regular file owned
+    by us, another file is created exclusively using mkstemp().
+    """
+    data_file = getattr(_data_files, 'data_file', None)
+    if data_file is not None:
+        try:
+            # O_NONBLOCK makes opening a FIFO fail instead of blocking until
+            # it has a reader; it has no effect on regular files.
+            fd = os.open(data_file.path,
+                         os.O_WRONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+        except OSError:  # ENOENT, ELOOP for symlink, ENXIO for FIFO
+            fd = None
+        if fd is not None:
+            st = os.fstat(fd)
+            if stat.S_ISREG(st.st_mode) and st.st_uid == os.geteuid():
+                os.ftruncate(fd, 0)
+                return fd, data_file.path
+            os.close(fd)
+
+        # The path may belong to someone else now; never remove it.
+        data_file.detach()
+
+    fd, path = tempfile.mkstemp()
+    _data_files.data_file = _DataFile(path)
+    return fd, path
+
 
 def _runHooksDir(data, dir, vmconf={}, raiseError=True, errors=None, params={},
                  hookType=_DOMXML_HOOK):
     if errors is None:
         errors = []
 
+    # Return early before preparing the data file and the environment; most
+    # hook directories are empty.
     scripts = _scriptsPerDir(dir)
-    scripts.sort()
-
     if not scripts:
         return data
 
-    data_fd, data_filename = tempfile.mkstemp()
+    data_fd, data_filename = _open_data_file()
     try:
-        if hookType == _DOMXML_HOOK:
-            os.write(data_fd, data.encode('utf-8') if data else b'')
-        elif hookType == _JSON_HOOK:
-            os.write(data_fd, json.dumps(data).encode('utf-8'))
-        os.close(data_fd)
+        try:
+            if hookType == _DOMXML_HOOK:
+                os.write(data_fd, data.encode('utf-8') if data else b'')
+            elif hookType == _JSON_HOOK:
+                os.write(data_fd, json.dumps(data).encode('utf-8'))
+        finally:
+            os.close(data_fd)
 
-        scriptenv = os.environ.copy()
+        scriptenv = _base_env.copy()
 
         # Update the environment using params and custom configuration
-        env_update = [six.iteritems(params),
-                      six.iteritems(vmconf.get('custom', {}))]
-
-        # On py2 encode custom properties with default system encoding
-        # and save them to scriptenv. Pass str objects (byte-strings)
-        # without any conversion
-        for k, v in itertools.chain(*env_update):
-            try:
-                if six.PY2 and isinstance(v, six.text_type):
-                    scriptenv[k] = v.encode(sys.getfilesystemencoding())
-                else:
-                    scriptenv[k] = v
-            except UnicodeEncodeError:
-                pass
+        scriptenv.update(_utf8_items(params))
+        scriptenv.update(_utf8_items(vmconf.get('custom', {})))
 
         if vmconf.get('vmId'):
             scriptenv['vmId'] = vmconf.get('vmId')
@@ -95,12 +196,19 @@ def _runHooksDir(data, dir, vmconf={}, raiseError=True, errors=None, params={},
         elif hookType == _JSON_HOOK:
             scriptenv['_hook_json'] = data_filename
 
+        # subprocess encodes the environment for every child; encode it once
+        # for all the scripts instead.
+        scriptenv = {os.fsencode(k): os.fsencode(v)
+                     for k, v in scriptenv.items()}
+
         for s in scripts:
-            p = commands.start([s], stdout=subprocess.PIPE,
+            # Hooks output is not used; with only stderr piped,
+            # communicate() reads it directly without polling two pipes.
+            p = commands.start([s], stdout=subprocess.DEVNULL,
                                stderr=subprocess.PIPE, env=scriptenv)
 
             with commands.terminating(p):
-                (out, err) = p.communicate()
+                _, err = p.communicate()
 
             rc = p.returncode
             logging.info('%s: rc=%s err=%s', s, rc, err)
@@ -118,13 +226,31 @@ def _runHooksDir(data, dir, vmconf={}, raiseError=True, errors=None, params={},
         with open(data_filename, encoding='utf-8') as f:
             final_data = f.read()
     finally:
-        os.unlink(data_filename)
+        # Do not keep the data around until the next hook runs.
+        try:
+            os.truncate(data_filename, 0)
+        except FileNotFoundError:
+            pass
     if hookType == _DOMXML_HOOK:
         return final_data
     elif hookType == _JSON_HOOK:
         return json.loads(final_data)
 
 
+def _utf8_items(env):
+    """
+    Yield items of env, skipping values that cannot be encoded to UTF-8,
+    such as strings with surrogate escapes.
+    """
+    for k, v in env.items():
+        if isinstance(v, str):
+            try:
+                v.encode('utf-8')
+            except UnicodeEncodeError:
+                continue
+        yield k, v
+
+
 def before_device_create(devicexml, vmconf={}, customProperties={}):
     return _runHooksDir(devicexml, 'before_device_create', vmconf=vmconf,
                         params=customProperties)
@@ -418,12 +544,58 @@ def after_hostdev_list_by_caps(devices):
                         raiseError=False, hookType=_JSON_HOOK)
 
 
+def _file_digest(f, name):
+    # hashlib.file_digest() is available since python 3.11; it hashes the
+    # file in C without copying the data through python objects.
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(f, name)
+    digest = hashlib.new(name)
+    for chunk in iter(lambda: f.read(_DIGEST_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest
+
+
+def _digestKey(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def _cachedChecksum(path):
+    """
+    Return the cached checksum of path, or None if it is not cached or the
+    script was modified.
+    """
+    cached = _digest_cache.get(path)
+    if cached is None:
+        return None
+    try:
+        st = os.stat(path)
+    except EnvironmentError:
+        return None
+    if cached[0] != _digestKey(st):
+        return None
+    return cached[1]
+
+
 def _getScriptInfo(path):
+    digest = _cachedChecksum(path)
+    if digest is not None:
+        return {'checksum': digest}
+
+    # Take the cache key from the file we hash, so a script replaced
+    # between stat() and open() is not cached with the old key.
     try:
         with open(path, 'rb') as f:
-            digest = hashlib.sha256(f.read()).hexdigest()
+            st = os.fstat(f.fileno())
+            digest = _file_digest(f, 'sha256').hexdigest()
     except EnvironmentError:
-        digest = ''
+        _digest_cache.pop(path, None)
+        return {'checksum': ''}
+
+    if _cacheable(st):
+        _digest_cache[path] = (_digestKey(st), digest)
+    else:
+        _digest_cache.pop(path, None)
+
     return {'checksum': digest}
 
 
@@ -454,8 +626,34 @@ def remove_vm_launch_flags_file(vm_id):
 
 
 def _getHookInfo(dir):
-    return dict((os.path.basename(script), _getScriptInfo(script))
-                for script in _scriptsPerDir(dir))
+    info = {}
+    missing = []
+    for script in _scriptsPerDir(dir):
+        digest = _cachedChecksum(script)
+        if digest is None:
+            missing.append(script)
+        else:
+            info[os.path.basename(script)] = {'checksum': digest}
+
+    # Usually all checksums are cached. Computing checksums of few scripts
+    # is also faster than starting threads.
+    if len(missing) < _HOOK_INFO_MIN_PARALLEL:
+        for script in missing:
+            info[os.path.basename(script)] = _getScriptInfo(script)
+        return info
+
+    for res in concurrent.tmap(_getNamedScriptInfo, missing,
+                               max_workers=_HOOK_INFO_MAX_WORKERS,
+                               name="hookinfo"):
+        if not res.succeeded:
+            raise res.value
+        name, script_info = res.value
+        info[name] = script_info
+    return info
+
+
+def _getNamedScriptInfo(path):
+    return os.path.basename(path), _getScriptInfo(path)
 
 
 def installed():
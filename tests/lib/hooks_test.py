@@ -5,15 +5,15 @@ from __future__ import absolute_import
 from __future__ import division
 
 import hashlib
-import itertools
+import json
 import libvirt
 import logging
-import textwrap
 import os
 import os.path
-import pickle
 import pytest
 import sys
+import threading
+import time
 
 from collections import namedtuple
 
@@ -26,6 +26,10 @@ def on_ascii_locale():
     return locale == "ASCII" or locale == "ANSI_X3.4-1968"
 
 
+requires_root = pytest.mark.skipif(
+    os.geteuid() != 0, reason="requires root")
+
+
 DirEntry = namedtuple("DirEntry", "name, mode, contents")
 FileEntry = namedtuple("FileEntry", "name, mode, contents")
 
@@ -39,9 +43,14 @@ def dir_entry_apply(self, hooks_dir):
 
 
 def file_entry_apply(self, hooks_dir):
-    path = hooks_dir.join(self.name)
-    path.write(self.contents)
-    path.chmod(self.mode)
+    path = str(hooks_dir.join(self.name))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.mode)
+    try:
+        os.write(fd, self.contents.encode("utf-8"))
+    finally:
+        os.close(fd)
+    # Mode passed to open() is masked by umask.
+    os.chmod(path, self.mode)
 
 
 DirEntry.apply = dir_entry_apply
@@ -65,6 +74,8 @@ def hooks_dir(fake_hooks_root, request):
     for entry in entries:
         entry.apply(hooks_dir)
     yield hooks_dir
+    hooks._scripts_cache.clear()
+    hooks._digest_cache.clear()
 
 
 @pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
@@ -80,7 +91,8 @@ def test_scripts_per_dir_should_list_scripts(hooks_dir):
     scripts = hooks._scriptsPerDir(hooks_dir.basename)
 
     assert len(scripts) == 2
-    assert sorted(scripts) == sorted(list(str(p) for p in hooks_dir.visit()))
+    with os.scandir(str(hooks_dir)) as it:
+        assert sorted(scripts) == sorted(e.path for e in it)
 
 
 @pytest.mark.parametrize("hooks_dir", indirect=True, argvalues=[
@@ -96,6 +108,12 @@ def test_scripts_per_dir_should_list_scripts(hooks_dir):
         ],
         id="executable directory"
     ),
+    pytest.param(
+        [
+            FileEntry(".hidden", 0o777, ""),
+        ],
+        id="hidden script"
+    ),
     pytest.param(
         [
             DirEntry("nested", 0o777, [
@@ -120,6 +138,11 @@ def test_scripts_per_dir_should_not_list(hooks_dir):
         "Hook directory paths cannot contain '..'",
         id="escaping relative path"
     ),
+    pytest.param(
+        "hooks_dir/../../tmp/evil",
+        "Hook directory paths cannot contain '..'",
+        id="escaping nested relative path"
+    ),
 ])
 def test_scripts_per_dir_should_raise(fake_hooks_root, dir_name, error):
     with pytest.raises(ValueError) as e:
@@ -146,10 +169,110 @@ def test_scripts_per_dir_should_accept_root_without_trailing_slash(monkeypatch,
         assert len(scripts) == 1
 
 
+@pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
+    pytest.param(
+        [
+            FileEntry("executable", 0o700, ""),
+        ],
+        id="one executable script"
+    ),
+])
+def test_scripts_per_dir_should_use_cached_listing(monkeypatch, hooks_dir):
+    monkeypatch.setattr(hooks, "_CACHE_MIN_AGE", -1)
+    scripts = hooks._scriptsPerDir(hooks_dir.basename)
+
+    with monkeypatch.context() as m:
+        m.setattr(hooks.os, "scandir", None)
+        assert hooks._scriptsPerDir(hooks_dir.basename) == scripts
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
+    pytest.param(
+        [
+            FileEntry("executable", 0o700, ""),
+        ],
+        id="one executable script"
+    ),
+])
+def test_scripts_per_dir_should_list_new_scripts(hooks_dir):
+    assert len(hooks._scriptsPerDir(hooks_dir.basename)) == 1
+
+    FileEntry("executable_2", 0o700, "").apply(hooks_dir)
+
+    assert len(hooks._scriptsPerDir(hooks_dir.basename)) == 2
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
+    pytest.param(
+        [
+            FileEntry("executable", 0o700, ""),
+            FileEntry("non-executable", 0o600, ""),
+        ],
+        id="executable and non-executable scripts"
+    ),
+])
+def test_scripts_per_dir_should_list_enabled_script(monkeypatch, hooks_dir):
+    monkeypatch.setattr(hooks, "_CACHE_MIN_AGE", -1)
+    assert len(hooks._scriptsPerDir(hooks_dir.basename)) == 1
+
+    hooks_dir.join("non-executable").chmod(0o700)
+
+    assert len(hooks._scriptsPerDir(hooks_dir.basename)) == 2
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
+    pytest.param(
+        [
+            FileEntry("executable", 0o700, ""),
+            FileEntry("executable_2", 0o700, ""),
+        ],
+        id="two executable scripts"
+    ),
+])
+def test_scripts_per_dir_should_not_list_disabled_script(monkeypatch,
+                                                         hooks_dir):
+    monkeypatch.setattr(hooks, "_CACHE_MIN_AGE", -1)
+    assert len(hooks._scriptsPerDir(hooks_dir.basename)) == 2
+
+    hooks_dir.join("executable_2").chmod(0o600)
+
+    assert hooks._scriptsPerDir(hooks_dir.basename) == [
+        str(hooks_dir.join("executable"))
+    ]
+
+
+def test_scripts_per_dir_should_not_list_broken_symlink(monkeypatch,
+                                                        fake_hooks_root,
+                                                        hooks_dir):
+    monkeypatch.setattr(hooks, "_CACHE_MIN_AGE", -1)
+    FileEntry("target", 0o700, "").apply(fake_hooks_root)
+    target = fake_hooks_root.join("target")
+    hooks_dir.join("link").mksymlinkto(target)
+    assert len(hooks._scriptsPerDir(hooks_dir.basename)) == 1
+
+    target.remove()
+
+    assert hooks._scriptsPerDir(hooks_dir.basename) == []
+
+
+def test_scripts_per_dir_should_handle_missing_dir(fake_hooks_root):
+    assert hooks._scriptsPerDir("missing_dir") == []
+
+
 def test_rhd_should_return_unmodified_data_when_no_hooks(hooks_dir):
     assert hooks._runHooksDir(u"algo", hooks_dir.basename) == u"algo"
 
 
+def test_rhd_should_not_create_data_file_when_no_hooks(monkeypatch,
+                                                       hooks_dir):
+    def fail():
+        raise AssertionError("data file created")
+
+    monkeypatch.setattr(hooks, "_data_files", threading.local())
+    monkeypatch.setattr(hooks.tempfile, "mkstemp", fail)
+    hooks._runHooksDir(u"algo", hooks_dir.basename)
+
+
 @pytest.fixture
 def dummy_hook(hooks_dir):
     FileEntry("hook.sh", 0o755, "#!/bin/bash").apply(hooks_dir)
@@ -202,15 +325,17 @@ def test_rhd_should_handle_json_data(dummy_hook, hooks_dir, data, expected):
     assert result == expected
 
 
+_APPENDER_SCRIPT_TMPL = """\
+#!/bin/bash
+myname="$(basename "$0")"
+echo "$myname" >> "$_hook_domxml"
+>&2 echo "$myname"
+exit {exit_code}
+"""
+
+
 def appender_script(script_name, exit_code=0):
-    code = textwrap.dedent(
-        """\
-        #!/bin/bash
-        myname="$(basename "$0")"
-        echo "$myname" >> "$_hook_domxml"
-        >&2 echo "$myname"
-        exit {exit_code}
-        """.format(exit_code=exit_code))
+    code = _APPENDER_SCRIPT_TMPL.format(exit_code=exit_code)
     return FileEntry(script_name, 0o777, code)
 
 
@@ -228,13 +353,13 @@ def test_rhd_should_run_a_hook(hooks_dir):
 
 @pytest.mark.parametrize("hooks_dir", indirect=True, argvalues=[
     pytest.param(
-        perm,
-        id="-".join(script.name for script in perm)
-    ) for perm in itertools.permutations([
-        appender_script("1.sh"),
-        appender_script("2.sh"),
-        appender_script("3.sh")
-    ])
+        [
+            appender_script("3.sh"),
+            appender_script("1.sh"),
+            appender_script("2.sh")
+        ],
+        id="created out of order"
+    ),
 ])
 def test_rhd_should_run_hooks_in_order(hooks_dir):
     assert hooks._runHooksDir(u"", hooks_dir.basename) == u"1.sh\n2.sh\n3.sh\n"
@@ -328,25 +453,21 @@ def test_rhd_should_report_hook_stderr(caplog, hooks_dir):
                              if lvl == logging.INFO)
 
 
+_ENV_DUMP_SCRIPT_TMPL = """\
+#!{python}
+import json
+import os
+
+with open("{dump_path}", "w") as dump_file:
+    json.dump(dict(os.environ), dump_file)
+"""
+
+
 @pytest.fixture
 def env_dump(hooks_dir):
-    dump_path = str(hooks_dir.join("env_dump.pickle"))
-    code = textwrap.dedent(
-        """\
-        #!{}
-        import os
-        import pickle
-        import six
-        import sys
-
-        with open("{}", "wb") as dump_file:
-            env = dict()
-            for k, v in os.environ.items():
-                if six.PY2:
-                    v = v.decode(sys.getfilesystemencoding())
-                env[k] = v
-            pickle.dump(env, dump_file)
-        """).format(sys.executable, dump_path)
+    dump_path = str(hooks_dir.join("env_dump.json"))
+    code = _ENV_DUMP_SCRIPT_TMPL.format(python=sys.executable,
+                                        dump_path=dump_path)
     FileEntry("env_dump.py", 0o755, code).apply(hooks_dir)
     yield dump_path
 
@@ -394,13 +515,34 @@ def env_dump(hooks_dir):
 def test_rhd_should_assemble_environment_for_hooks(hooks_dir, env_dump, vmconf,
                                                    params, expected):
     hooks._runHooksDir(u"", hooks_dir.basename, vmconf, params=params)
-    with open(env_dump, "rb") as f:
-        env = pickle.load(f)
+    with open(env_dump) as f:
+        env = json.load(f)
 
     for k, v in expected.items():
         assert env[k] == v
 
 
+@pytest.mark.parametrize("vmconf, params", [
+    pytest.param(
+        {},
+        {"abc": u"\udcfc"},
+        id="invalid param"
+    ),
+    pytest.param(
+        {"custom": {"abc": u"def\udcfc"}},
+        {},
+        id="invalid vmconf param"
+    ),
+])
+def test_rhd_should_skip_invalid_utf8_variables(hooks_dir, env_dump, vmconf,
+                                                params):
+    hooks._runHooksDir(u"", hooks_dir.basename, vmconf, params=params)
+    with open(env_dump) as f:
+        env = json.load(f)
+
+    assert "abc" not in env
+
+
 @pytest.fixture
 def mkstemp_path(monkeypatch, hooks_dir):
     with monkeypatch.context() as m:
@@ -410,6 +552,7 @@ def mkstemp_path(monkeypatch, hooks_dir):
             return os.open(tmp_path, os.O_RDWR | os.O_CREAT, 0o600), tmp_path
 
         m.setattr(hooks.tempfile, 'mkstemp', impl)
+        m.setattr(hooks, '_data_files', threading.local())
         yield tmp_path
 
 
@@ -428,24 +571,173 @@ def mkstemp_path(monkeypatch, hooks_dir):
 def test_rhd_should_pass_data_file_to_hooks(hooks_dir, env_dump, mkstemp_path,
                                             var_name, hook_type):
     hooks._runHooksDir(None, hooks_dir.basename, hookType=hook_type)
-    with open(env_dump, "rb") as f:
-        env = pickle.load(f)
+    with open(env_dump) as f:
+        env = json.load(f)
 
     assert env[var_name] == mkstemp_path
 
 
+_FD_CHECK_SCRIPT = """\
+#!/bin/bash
+for fd in /proc/self/fd/*; do
+    if [ "$(readlink "$fd")" = "$_hook_domxml" ]; then
+        >&2 echo "data file inherited as $fd"
+        exit 1
+    fi
+done
+"""
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=True, argvalues=[
+    pytest.param(
+        [
+            FileEntry("fd_check.sh", 0o755, _FD_CHECK_SCRIPT),
+        ],
+        id="fd check hook"
+    ),
+])
+def test_rhd_should_not_leak_data_file_fd(hooks_dir):
+    hooks._runHooksDir(u"", hooks_dir.basename)
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=True, argvalues=[
+    pytest.param(
+        [
+            appender_script("1.sh"),
+        ],
+        id="single hook"
+    ),
+])
+def test_rhd_should_reuse_data_file(monkeypatch, hooks_dir):
+    monkeypatch.setattr(hooks, '_data_files', threading.local())
+    assert hooks._runHooksDir(u"a", hooks_dir.basename) == u"a1.sh\n"
+    data_file = hooks._data_files.data_file.path
+
+    assert os.path.getsize(data_file) == 0
+    assert hooks._runHooksDir(u"b", hooks_dir.basename) == u"b1.sh\n"
+    assert hooks._data_files.data_file.path == data_file
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=True, argvalues=[
+    pytest.param(
+        [
+            appender_script("1.sh"),
+        ],
+        id="single hook"
+    ),
+])
+def test_rhd_should_recreate_removed_data_file(monkeypatch, hooks_dir):
+    monkeypatch.setattr(hooks, '_data_files', threading.local())
+    hooks._runHooksDir(u"a", hooks_dir.basename)
+    data_file = hooks._data_files.data_file.path
+    os.unlink(data_file)
+
+    assert hooks._runHooksDir(u"b", hooks_dir.basename) == u"b1.sh\n"
+    assert hooks._data_files.data_file.path != data_file
+    assert not os.path.exists(data_file)
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=True, argvalues=[
+    pytest.param(
+        [
+            appender_script("1.sh"),
+        ],
+        id="single hook"
+    ),
+])
+def test_rhd_should_not_follow_replaced_data_file(monkeypatch, tmpdir,
+                                                  hooks_dir):
+    monkeypatch.setattr(hooks, '_data_files', threading.local())
+    hooks._runHooksDir(u"a", hooks_dir.basename)
+    data_file = hooks._data_files.data_file.path
+    os.unlink(data_file)
+    target = tmpdir.join("target")
+    target.write("evil")
+    os.symlink(str(target), data_file)
+    try:
+        assert hooks._runHooksDir(u"b", hooks_dir.basename) == u"b1.sh\n"
+        assert hooks._data_files.data_file.path != data_file
+        assert target.read() == "evil"
+    finally:
+        os.unlink(data_file)
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=True, argvalues=[
+    pytest.param(
+        [
+            appender_script("1.sh"),
+        ],
+        id="single hook"
+    ),
+])
+def test_rhd_should_not_open_fifo_data_file(monkeypatch, hooks_dir):
+    monkeypatch.setattr(hooks, '_data_files', threading.local())
+    hooks._runHooksDir(u"a", hooks_dir.basename)
+    data_file = hooks._data_files.data_file.path
+    os.unlink(data_file)
+    os.mkfifo(data_file)
+    try:
+        assert hooks._runHooksDir(u"b", hooks_dir.basename) == u"b1.sh\n"
+        assert hooks._data_files.data_file.path != data_file
+    finally:
+        os.unlink(data_file)
+
+
+@requires_root
+@pytest.mark.parametrize("hooks_dir", indirect=True, argvalues=[
+    pytest.param(
+        [
+            appender_script("1.sh"),
+        ],
+        id="single hook"
+    ),
+])
+def test_rhd_should_not_use_data_file_owned_by_others(monkeypatch,
+                                                      hooks_dir):
+    monkeypatch.setattr(hooks, '_data_files', threading.local())
+    hooks._runHooksDir(u"a", hooks_dir.basename)
+    data_file = hooks._data_files.data_file.path
+    with open(data_file, "w") as f:
+        f.write("evil")
+    os.chmod(data_file, 0o666)
+    os.chown(data_file, 65534, 65534)
+    try:
+        assert hooks._runHooksDir(u"b", hooks_dir.basename) == u"b1.sh\n"
+        assert hooks._data_files.data_file.path != data_file
+        with open(data_file) as f:
+            assert f.read() == "evil"
+    finally:
+        os.unlink(data_file)
+
+
+def test_data_file_should_be_removed_with_thread():
+    def run():
+        fd, path = hooks._open_data_file()
+        os.close(fd)
+        results.append(path)
+
+    results = []
+    t = threading.Thread(target=run)
+    t.start()
+    t.join()
+
+    assert not os.path.exists(results[0])
+
+
+_HOOKING_CLIENT_TMPL = """\
+#!{python}
+import sys
+
+try:
+    import hooking
+except ImportError:
+    sys.exit(2)
+"""
+
+
 @pytest.fixture
 def hooking_client(hooks_dir):
-    code = textwrap.dedent(
-        """\
-        #!{}
-        import sys
-
-        try:
-            import hooking
-        except ImportError:
-            sys.exit(2)
-        """).format(sys.executable)
+    code = _HOOKING_CLIENT_TMPL.format(python=sys.executable)
     FileEntry("hook_client.py", 0o755, code).apply(hooks_dir)
     yield
 
@@ -463,6 +755,13 @@ def test_rhd_should_make_import_hooking_possible(hooks_dir, hooking_client):
         hashlib.sha256(b"abc").hexdigest(),
         id="simple script"
     ),
+    pytest.param(
+        [
+            FileEntry("script.sh", 0o777, "a" * 1024**2)
+        ],
+        hashlib.sha256(b"a" * 1024**2).hexdigest(),
+        id="large script"
+    ),
     pytest.param(
         [],
         "",
@@ -475,6 +774,63 @@ def test_get_script_info_should_return_checksum(hooks_dir, expected):
     assert hooks._getScriptInfo(path) == {"checksum": expected}
 
 
+@pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
+    pytest.param(
+        [
+            FileEntry("script.sh", 0o777, "abc")
+        ],
+        id="simple script"
+    ),
+])
+def test_get_script_info_should_use_cached_checksum(monkeypatch, hooks_dir):
+    monkeypatch.setattr(hooks, "_CACHE_MIN_AGE", -1)
+    path = str(hooks_dir.join("script.sh"))
+    info = hooks._getScriptInfo(path)
+
+    with monkeypatch.context() as m:
+        m.setattr(hooks, "_file_digest", None)
+        assert hooks._getScriptInfo(path) == info
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
+    pytest.param(
+        [
+            FileEntry("script.sh", 0o777, "abc")
+        ],
+        id="simple script"
+    ),
+])
+def test_get_script_info_should_not_cache_recently_changed_script(hooks_dir):
+    path = str(hooks_dir.join("script.sh"))
+    # Like a package install: old mtime, but a fresh ctime.
+    old = time.time() - 3600
+    os.utime(path, (old, old))
+    hooks._getScriptInfo(path)
+
+    assert path not in hooks._digest_cache
+
+
+@pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
+    pytest.param(
+        [
+            FileEntry("script.sh", 0o777, "abc")
+        ],
+        id="simple script"
+    ),
+])
+def test_get_script_info_should_detect_modified_script(monkeypatch,
+                                                       hooks_dir):
+    monkeypatch.setattr(hooks, "_CACHE_MIN_AGE", -1)
+    path = str(hooks_dir.join("script.sh"))
+    hooks._getScriptInfo(path)
+
+    FileEntry("script.sh", 0o777, "abcd").apply(hooks_dir)
+
+    assert hooks._getScriptInfo(path) == {
+        "checksum": hashlib.sha256(b"abcd").hexdigest()
+    }
+
+
 @pytest.mark.parametrize("hooks_dir, expected", indirect=["hooks_dir"],
                          argvalues=[
     pytest.param(
@@ -493,11 +849,43 @@ def test_get_script_info_should_return_checksum(hooks_dir, expected):
         {},
         id="no scripts"
     ),
+    pytest.param(
+        [
+            FileEntry("script%d.sh" % i, 0o777, str(i))
+            for i in range(10)
+        ],
+        {
+            "script%d.sh" % i: {
+                "checksum": hashlib.sha256(str(i).encode()).hexdigest()
+            }
+            for i in range(10)
+        },
+        id="many scripts"
+    ),
 ])
 def test_get_hook_info_should_return_info(hooks_dir, expected):
     assert hooks._getHookInfo(hooks_dir.basename) == expected
 
 
+@pytest.mark.parametrize("hooks_dir", indirect=["hooks_dir"], argvalues=[
+    pytest.param(
+        [
+            FileEntry("script%d.sh" % i, 0o777, str(i))
+            for i in range(10)
+        ],
+        id="many scripts"
+    ),
+])
+def test_get_hook_info_should_not_start_threads_when_cached(monkeypatch,
+                                                            hooks_dir):
+    monkeypatch.setattr(hooks, "_CACHE_MIN_AGE", -1)
+    info = hooks._getHookInfo(hooks_dir.basename)
+
+    with monkeypatch.context() as m:
+        m.setattr(hooks.concurrent, "tmap", None)
+        assert hooks._getHookInfo(hooks_dir.basename) == info
+
+
 @pytest.mark.parametrize("fake_hooks_root, expected",
                          indirect=["fake_hooks_root"],
                          argvalues=[